@@ -20,46 +20,125 @@ from SCons.Script import AlwaysBuild
 Import("env")
 
 
+_PRELIMINARY_PROG_PATH = os.path.join("$BUILD_DIR", "zephyr", "firmware-pre")
+_PRELIMINARY_LDSCRIPT_PATH = os.path.join(
+    "$BUILD_DIR", "zephyr", "linker_zephyr_prebuilt.cmd"
+)
+_FINAL_LDSCRIPT_PATH = os.path.join("$BUILD_DIR", "zephyr", "linker.cmd")
+_BUILD_TYPE = None
+
+
+def is_ninja_generation_enabled(env):
+    return bool(env.get("NINJA")) or env.BoardConfig().get(
+        "build.zephyr.ninja", ""
+    ).lower() in ("1", "yes", "true")
+
+
 def ZephyrBuildProgram(env):
+    global _BUILD_TYPE
+
+    # Trust timestamps first and hash the content only when a file's mtime has
+    # changed. Null builds skip reading thousands of Zephyr sources at the cost
+    # of missing edits that leave the modification time of a file unchanged
+    env.Decider("MD5-timestamp")
+
+    # Allow overriding the number of parallel jobs from the environment
+    build_jobs = os.environ.get("PLATFORMIO_BUILD_JOBS", "").strip()
+    if build_jobs:
+        try:
+            num_jobs = int(build_jobs)
+        except ValueError:
+            num_jobs = 0
+        if num_jobs >= 1:
+            env.SetOption("num_jobs", num_jobs)
+        else:
+            print(
+                "Warning! Ignoring invalid PLATFORMIO_BUILD_JOBS value `%s`, "
+                "expected a positive integer" % os.environ["PLATFORMIO_BUILD_JOBS"]
+            )
+
+    # Let Ninja handle incremental rebuilds from a generated build.ninja file
+    use_ninja = is_ninja_generation_enabled(env)
+    if use_ninja:
+        env.SetOption("experimental", "ninja")
+        env.Tool("ninja")
+
     env["LDSCRIPT_PATH"] = None
     env.ProcessProgramDeps()
     env.ProcessProjectDeps()
 
-    # append into the beginning a main LD script
+    # append into the beginning a main LD script, the actual script is selected
+    # per target via LDSCRIPT_PATH
     env.Prepend(LINKFLAGS=["-T", "$LDSCRIPT_PATH"])
 
     # enable "cyclic reference" for linker
-    if env.get("LIBS") and env.GetCompilerType() == "gcc":
-        env.Prepend(_LIBFLAGS="-Wl,--start-group ")
-        env.Append(_LIBFLAGS=" -Wl,--end-group")
+    link_group = env.get("ZEPHYR_LINK_GROUP", "auto")
+    if link_group != "off" and env.get("LIBS") and env.GetCompilerType() == "gcc":
+        cyclic_libs = env.get("ZEPHYR_CYCLIC_LIBS", [])
+        if link_group == "auto" and cyclic_libs:
+            # Only libraries with known circular references are rescanned
+            env.Append(
+                _LIBFLAGS=" -Wl,--start-group %s -Wl,--end-group"
+                % " ".join(env.Flatten([cyclic_libs]))
+            )
+        else:
+            env.Prepend(_LIBFLAGS="-Wl,--start-group ")
+            env.Append(_LIBFLAGS=" -Wl,--end-group")
+
+    preliminary_ldscript = env.File(_PRELIMINARY_LDSCRIPT_PATH)
+    final_ldscript = env.File(_FINAL_LDSCRIPT_PATH)
 
     program_pre = env.Program(
-        os.path.join("$BUILD_DIR", "zephyr", "firmware-pre"), env["PIOBUILDFILES"],
-        LDSCRIPT_PATH=os.path.join("$BUILD_DIR", "zephyr", "linker_zephyr_prebuilt.cmd")
+        _PRELIMINARY_PROG_PATH,
+        env["PIOBUILDFILES"],
+        LDSCRIPT_PATH=preliminary_ldscript,
     )
 
+    # PlatformIO enables the build cache when `build_cache_dir` is configured. The
+    # preliminary image only exists to generate the ISR tables and device handles,
+    # caching it would store a partial link stage
+    env.NoCache(program_pre)
+
     # Force execution of offset header target before compiling project sources
     env.Depends(env["PIOBUILDFILES"], env["__ZEPHYR_OFFSET_HEADER_CMD"])
+    env.NoCache(env["__ZEPHYR_OFFSET_HEADER_CMD"])
+
+    env.Replace(
+        _ZEPHYR_ALL_BUILDFILES=env.Flatten(
+            [env["PIOBUILDFILES"], env["_EXTRA_ZEPHYR_PIOBUILDFILES"]]
+        )
+    )
 
     program = env.Program(
-        os.path.join("$BUILD_DIR", env.subst("$PROGNAME")),
-        env["PIOBUILDFILES"] + env["_EXTRA_ZEPHYR_PIOBUILDFILES"],
-        LDSCRIPT_PATH=os.path.join("$BUILD_DIR", "zephyr", "linker.cmd")
+        os.path.join("$BUILD_DIR", "$PROGNAME"),
+        env["_ZEPHYR_ALL_BUILDFILES"],
+        LDSCRIPT_PATH=final_ldscript,
     )
 
-    env.Depends(program, program_pre)
+    # There is no direct dependency on the preliminary image, it's reached only
+    # through the ISR table and device handles sources compiled into the final one
+    env.Precious(program_pre)
+    env.NoClean(program_pre)
 
     env.Replace(PIOMAINPROG=program)
 
-    AlwaysBuild(
-        env.Alias(
-            "checkprogsize",
-            program,
-            env.VerboseAction(env.CheckUploadSize, "Checking size $PIOMAINPROG"),
+    # Python actions would re-enter SCons from Ninja on every build
+    if use_ninja:
+        print("Warning! Program size check is disabled when Ninja generation is enabled")
+        env.Alias("checkprogsize", program)
+    else:
+        AlwaysBuild(
+            env.Alias(
+                "checkprogsize",
+                program,
+                env.VerboseAction(env.CheckUploadSize, "Checking size $PIOMAINPROG"),
+            )
         )
-    )
 
-    print("Building in %s mode" % env.GetBuildType())
+    if _BUILD_TYPE is None:
+        _BUILD_TYPE = env.GetBuildType()
+        print("Building in %s mode" % _BUILD_TYPE)
+    env["ZEPHYR_BUILD_TYPE"] = _BUILD_TYPE
 
     return program
 
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import hashlib
 import json
 import os
 import subprocess
@@ -19,6 +21,8 @@ import shutil
 import sys
 import re
 import tempfile
+import types
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import click
 
@@ -53,6 +57,20 @@ except ImportError:
 
     import yaml
 
+try:
+    # libyaml based loader is much faster than the pure Python implementation
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
+
+try:
+    # Optional faster JSON parser, the standard module is used as a fallback
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 
 platform = env.PioPlatform()
 board = env.BoardConfig()
@@ -67,6 +85,13 @@ PROJECT_SRC_DIR = env.subst("$PROJECT_SRC_DIR")
 CMAKE_API_DIR = os.path.join(BUILD_DIR, ".cmake", "api", "v1")
 CMAKE_API_QUERY_DIR = os.path.join(CMAKE_API_DIR, "query")
 CMAKE_API_REPLY_DIR = os.path.join(CMAKE_API_DIR, "reply")
+CMAKE_FINGERPRINT_FILE = os.path.join(BUILD_DIR, ".pio_cmake_fingerprint")
+CMAKE_BIN = os.path.join(platform.get_package_dir("tool-cmake") or "", "bin", "cmake")
+# At least 10 symbols are required in commit hash
+COMMIT_HASH_RE = re.compile(r"[0-9a-f]{10,40}")
+
+# Normalized once, used to detect includes located inside the framework package
+FRAMEWORK_INCLUDE_PREFIX = fs.to_unix_path(FRAMEWORK_DIR).rstrip("/") + "/"
 
 PLATFORMS_WITH_EXTERNAL_HAL = {
     "atmelsam": ["st", "atmel"],
@@ -80,6 +105,7 @@ PLATFORMS_WITH_EXTERNAL_HAL = {
     "nxpimxrt": ["st", "nxp"],
     "teensy": ["st", "nxp"],
 }
+EXTERNAL_HALS = frozenset(PLATFORMS_WITH_EXTERNAL_HAL.get(env.subst("$PIOPLATFORM"), []))
 
 
 # By default Zephyr modules are cloned without submodules. Temporarily subclass
@@ -87,6 +113,9 @@ PLATFORMS_WITH_EXTERNAL_HAL = {
 class NonRecursiveGitClient(GitClient):
     def export(self):
         is_commit = self.is_commit_id(self.tag)
+        if is_commit and self._export_commit():
+            return True
+
         args = ["clone"]
         if not self.tag or not is_commit:
             args += ["--depth", "1"]
@@ -98,13 +127,43 @@ class NonRecursiveGitClient(GitClient):
             assert self.run_cmd(["reset", "--hard", self.tag])
         return True
 
+    def _export_commit(self):
+        # `git clone --branch` doesn't accept commit IDs, fetch only the required
+        # commit instead of the entire history of the repository
+        try:
+            assert self.run_cmd(["init", self.src_dir], cwd=os.getcwd())
+            assert self.run_cmd(["remote", "add", "origin", self.remote_url])
+            assert self.run_cmd(["fetch", "--depth", "1", "origin", self.tag])
+            assert self.run_cmd(["checkout", "FETCH_HEAD"])
+            return True
+        except Exception:
+            pass
+
+        # Some servers don't allow fetching unadvertised objects by commit ID,
+        # leave an empty folder for the full clone
+        if os.path.isdir(self.src_dir):
+            fs.rmtree(self.src_dir)
+        os.makedirs(self.src_dir)
+        return False
+
+
+@functools.lru_cache(maxsize=4096)
+def split_args(value):
+    # Fragments from CMake rarely contain quotes, a plain split is much cheaper
+    # than a shell-like lexer in that case. The same fragments are repeated
+    # across targets, results are cached as immutable tuples
+    if not any(c in value for c in "\"'\\"):
+        return tuple(value.split())
+    return tuple(click.parser.split_arg_string(value))
+
 
-def get_board_architecture(board_config):
-    if board_config.get("build.cpu", "").lower().startswith("cortex"):
+@functools.lru_cache(maxsize=1)
+def get_board_architecture():
+    if board.get("build.cpu", "").lower().startswith("cortex"):
         return "arm"
-    elif board_config.get("build.march", "").startswith(("rv64", "rv32")):
+    elif board.get("build.march", "").startswith(("rv64", "rv32")):
         return "riscv"
-    elif board_config.get("build.mcu") == "esp32":
+    elif board.get("build.mcu") == "esp32":
         return "xtensa32"
 
     sys.stderr.write(
@@ -116,7 +175,7 @@ def get_board_architecture(board_config):
 
 def populate_zephyr_env_vars(zephyr_env, board_config):
     toolchain_variant = "UNKNOWN"
-    arch = get_board_architecture(board_config)
+    arch = get_board_architecture()
     if arch == "arm":
         toolchain_variant = "gnuarmemb"
         zephyr_env["GNUARMEMB_TOOLCHAIN_PATH"] = platform.get_package_dir(
@@ -179,28 +238,69 @@ void main(void)
             fp.write(app_tpl)
 
 
+def get_cmake_inputs_fingerprint():
+    # Content hash of the files and options that affect the CMake configuration,
+    # so touching the framework package doesn't trigger a full reconfiguration
+    fingerprint = hashlib.blake2b(digest_size=16)
+    for input_file in (
+        os.path.join(PROJECT_DIR, "zephyr", "CMakeLists.txt"),
+        os.path.join(PROJECT_DIR, "zephyr", "prj.conf"),
+        os.path.join(PROJECT_DIR, "zephyr", "menuconfig.conf"),
+        os.path.join(FRAMEWORK_DIR, "west.yml"),
+    ):
+        fingerprint.update(input_file.encode() + b"\0")
+        if os.path.isfile(input_file):
+            with open(input_file, "rb") as fp:
+                fingerprint.update(fp.read())
+        fingerprint.update(b"\0")
+
+    for value in (
+        FRAMEWORK_VERSION,
+        get_zephyr_target(board),
+        board.get("build.zephyr.cmake_extra_args", ""),
+    ):
+        fingerprint.update(str(value).encode() + b"\0")
+
+    return fingerprint.hexdigest()
+
+
+def scan_dir_entries(path):
+    try:
+        with os.scandir(path) as it:
+            return {entry.name: entry for entry in it}
+    except OSError:
+        return {}
+
+
+def is_dir_empty(path):
+    try:
+        with os.scandir(path) as it:
+            # stop at the first entry instead of listing the whole folder
+            return not any(True for _ in it)
+    except OSError:
+        return True
+
+
 def is_cmake_reconfigure_required():
-    cmake_cache_file = os.path.join(BUILD_DIR, "CMakeCache.txt")
-    cmake_txt_file = os.path.join(PROJECT_DIR, "zephyr", "CMakeLists.txt")
     cmake_preconf_dir = os.path.join(BUILD_DIR, "zephyr", "include", "generated")
     cmake_preconf_misc = os.path.join(BUILD_DIR, "zephyr", "misc", "generated")
-    zephyr_prj_conf = os.path.join(PROJECT_DIR, "zephyr", "prj.conf")
 
+    # A single directory read covers all files expected in the build folder
+    build_dir_entries = scan_dir_entries(BUILD_DIR)
+    for f in (
+        "build.ninja",
+        "CMakeCache.txt",
+        os.path.basename(CMAKE_FINGERPRINT_FILE),
+    ):
+        entry = build_dir_entries.get(f)
+        if not entry or not entry.is_file():
+            return True
     for d in (CMAKE_API_REPLY_DIR, cmake_preconf_dir, cmake_preconf_misc):
-        if not os.path.isdir(d) or not os.listdir(d):
+        if is_dir_empty(d):
+            return True
+    with open(CMAKE_FINGERPRINT_FILE) as fp:
+        if fp.read().strip() != get_cmake_inputs_fingerprint():
             return True
-    if not os.path.isfile(cmake_cache_file):
-        return True
-    if not os.path.isfile(os.path.join(BUILD_DIR, "build.ninja")):
-        return True
-    if os.path.getmtime(cmake_txt_file) > os.path.getmtime(cmake_cache_file):
-        return True
-    if os.path.isfile(zephyr_prj_conf) and os.path.getmtime(
-        zephyr_prj_conf
-    ) > os.path.getmtime(cmake_cache_file):
-        return True
-    if os.path.getmtime(FRAMEWORK_DIR) > os.path.getmtime(cmake_cache_file):
-        return True
 
     return False
 
@@ -214,7 +314,7 @@ def run_cmake(manifest):
     )
 
     cmake_cmd = [
-        os.path.join(platform.get_package_dir("tool-cmake") or "", "bin", "cmake"),
+        CMAKE_BIN,
         "-S",
         os.path.join(PROJECT_DIR, "zephyr"),
         "-B",
@@ -235,7 +335,7 @@ def run_cmake(manifest):
 
     if board.get("build.zephyr.cmake_extra_args", ""):
         cmake_cmd.extend(
-            click.parser.split_arg_string(board.get("build.zephyr.cmake_extra_args"))
+            split_args(board.get("build.zephyr.cmake_extra_args"))
         )
 
     modules = [generate_default_component()]
@@ -284,27 +384,39 @@ def get_cmake_code_model(manifest):
             os.makedirs(os.path.dirname(query_file))
             open(query_file, "a").close()  # create an empty file
         run_cmake(manifest)
+        with open(CMAKE_FINGERPRINT_FILE, "w") as fp:
+            fp.write(get_cmake_inputs_fingerprint())
 
-    if not os.path.isdir(CMAKE_API_REPLY_DIR) or not os.listdir(CMAKE_API_REPLY_DIR):
+    reply_files = scan_dir_entries(CMAKE_API_REPLY_DIR)
+    if not reply_files:
         sys.stderr.write("Error: Couldn't find CMake API response file\n")
         env.Exit(1)
 
     codemodel = {}
-    for target in os.listdir(CMAKE_API_REPLY_DIR):
-        if target.startswith("codemodel-v2"):
-            with open(os.path.join(CMAKE_API_REPLY_DIR, target), "r") as fp:
-                codemodel = json.load(fp)
+    codemodel_files = [f for f in reply_files if f.startswith("codemodel-v2")]
+    if codemodel_files:
+        codemodel = load_reply_json(
+            os.path.join(CMAKE_API_REPLY_DIR, codemodel_files[-1])
+        )
 
     assert codemodel["version"]["major"] == 2
     return codemodel
 
 
+@functools.lru_cache(maxsize=None)
+def load_reply_json(path):
+    # Reply files are immutable during a build, each one is parsed only once
+    with open(path, "rb") as fp:
+        return json_loads(fp.read())
+
+
 def get_zephyr_target(board_config):
     return board_config.get("build.zephyr.variant", env.subst("$BOARD").lower())
 
 
-def get_target_elf_arch(board_config):
-    architecture = get_board_architecture(board_config)
+@functools.lru_cache(maxsize=1)
+def get_target_elf_arch():
+    architecture = get_board_architecture()
     if architecture == "arm":
         return "elf32-littlearm"
     if architecture == "riscv":
@@ -338,13 +450,12 @@ def build_library(default_env, lib_config, project_src_dir, prepend_dir=None):
 def get_target_config(project_configs, target_index):
     target_json = project_configs.get("targets")[target_index].get("jsonFile", "")
     target_config_file = os.path.join(CMAKE_API_REPLY_DIR, target_json)
-    if not os.path.isfile(target_config_file):
+    try:
+        return load_reply_json(target_config_file)
+    except OSError:
         sys.stderr.write("Error: Couldn't find target config %s\n" % target_json)
         env.Exit(1)
 
-    with open(target_config_file) as fp:
-        return json.load(fp)
-
 
 def _fix_package_path(module_path):
     # Possible package names in 'package@version' format is not compatible with CMake
@@ -354,7 +465,12 @@ def _fix_package_path(module_path):
             os.path.dirname(module_path),
             module_name.replace("@", "-"),
         )
-        os.rename(module_path, new_path)
+        if os.path.isdir(new_path):
+            # Already renamed by a previous build, drop the stale copy if any
+            if os.path.isdir(module_path):
+                fs.rmtree(module_path)
+        else:
+            os.rename(module_path, new_path)
         module_path = new_path
 
     assert module_path and os.path.isdir(module_path)
@@ -380,18 +496,47 @@ def generate_includible_file(source_file):
     )
 
 
+def get_file_digest(path):
+    with open(path, "rb") as fp:
+        return hashlib.blake2b(fp.read(), digest_size=16).hexdigest()
+
+
+def load_file_digest(path):
+    # Digests are kept next to the files they describe as `<file>.hash`
+    try:
+        with open(path + ".hash") as fp:
+            return fp.read().strip()
+    except OSError:
+        return ""
+
+
+def store_file_digest(path, digest):
+    with open(path + ".hash", "w") as fp:
+        fp.write(digest)
+
+
+def is_generated_file_up_to_date(output_files, input_digest):
+    # Outputs are regenerated only if the content of their input has changed
+    return all(os.path.isfile(f) for f in output_files) and (
+        load_file_digest(output_files[0]) == input_digest
+    )
+
+
 def generate_kobject_files():
-    kobj_files = (
-        os.path.join("$BUILD_DIR", "zephyr", "include", "generated", f)
+    kobj_files = [
+        os.path.join(BUILD_DIR, "zephyr", "include", "generated", f)
         for f in ("kobj-types-enum.h", "otype-to-str.h", "otype-to-size.h")
+    ]
+    input_digest = get_file_digest(
+        os.path.join(BUILD_DIR, "zephyr", "misc", "generated", "struct_tags.json")
     )
 
-    if all(os.path.isfile(env.subst(f)) for f in kobj_files):
+    if is_generated_file_up_to_date(kobj_files, input_digest):
         return
 
     cmd = (
         "$PYTHONEXE",
-        '"%s"' % os.path.join(FRAMEWORK_DIR, "scripts", "gen_kobject_list.py"),
+        os.path.join(FRAMEWORK_DIR, "scripts", "gen_kobject_list.py"),
         "--kobj-types-output",
         os.path.join(
             "$BUILD_DIR", "zephyr", "include", "generated", "kobj-types-enum.h"
@@ -404,34 +549,37 @@ def generate_kobject_files():
         os.path.join("$BUILD_DIR", "zephyr", "misc", "generated", "struct_tags.json"),
     )
 
-    env.Execute(env.VerboseAction(" ".join(cmd), "Generating KObject files..."))
+    return cmd, "Generating KObject files...", (kobj_files[0], input_digest)
 
 
 def validate_driver():
 
     driver_header = os.path.join(
-        "$BUILD_DIR", "zephyr", "include", "generated", "driver-validation.h"
+        BUILD_DIR, "zephyr", "include", "generated", "driver-validation.h"
+    )
+    input_digest = get_file_digest(
+        os.path.join(BUILD_DIR, "zephyr", "misc", "generated", "struct_tags.json")
     )
 
-    if os.path.isfile(env.subst(driver_header)):
+    if is_generated_file_up_to_date([driver_header], input_digest):
         return
 
     cmd = (
         "$PYTHONEXE",
-        '"%s"' % os.path.join(FRAMEWORK_DIR, "scripts", "gen_kobject_list.py"),
+        os.path.join(FRAMEWORK_DIR, "scripts", "gen_kobject_list.py"),
         "--validation-output",
         driver_header,
         "--include",
         os.path.join("$BUILD_DIR", "zephyr", "misc", "generated", "struct_tags.json"),
     )
 
-    env.Execute(env.VerboseAction(" ".join(cmd), "Validating driver..."))
+    return cmd, "Validating driver...", (driver_header, input_digest)
 
 
 def generate_dev_handles(preliminary_elf_path):
-    cmd = (
+    cmd = [
         "$PYTHONEXE",
-        '"%s"' % os.path.join(FRAMEWORK_DIR, "scripts", "gen_handles.py"),
+        os.path.join(FRAMEWORK_DIR, "scripts", "gen_handles.py"),
         "--output-source",
         "$TARGET",
         "--kernel",
@@ -440,34 +588,35 @@ def generate_dev_handles(preliminary_elf_path):
         "__device_start",
         "--zephyr-base",
         FRAMEWORK_DIR,
-    )
+    ]
 
     return env.Command(
         os.path.join("$BUILD_DIR", "zephyr", "dev_handles.c"),
         preliminary_elf_path,
-        env.VerboseAction(" ".join(cmd), "Generating $TARGET"),
+        env.VerboseAction([cmd], "Generating $TARGET"),
     )
 
 
 def parse_syscalls():
+    # Substituted paths, SCons splits expanded variables on whitespace in list actions
     syscalls_config = os.path.join(
-        "$BUILD_DIR", "zephyr", "misc", "generated", "syscalls.json"
+        BUILD_DIR, "zephyr", "misc", "generated", "syscalls.json"
     )
 
     struct_tags = os.path.join(
-        "$BUILD_DIR", "zephyr", "misc", "generated", "struct_tags.json"
+        BUILD_DIR, "zephyr", "misc", "generated", "struct_tags.json"
     )
 
     if not all(os.path.isfile(env.subst(f)) for f in (syscalls_config, struct_tags)):
         cmd = [
             "$PYTHONEXE",
-            '"%s"' % os.path.join(FRAMEWORK_DIR, "scripts", "parse_syscalls.py"),
+            os.path.join(FRAMEWORK_DIR, "scripts", "parse_syscalls.py"),
             "--include",
-            '"%s"' % os.path.join(FRAMEWORK_DIR, "include"),
+            os.path.join(FRAMEWORK_DIR, "include"),
             "--include",
-            '"%s"' % os.path.join(FRAMEWORK_DIR, "drivers"),
+            os.path.join(FRAMEWORK_DIR, "drivers"),
             "--include",
-            '"%s"' % os.path.join(FRAMEWORK_DIR, "subsys", "net"),
+            os.path.join(FRAMEWORK_DIR, "subsys", "net"),
         ]
 
         # Temporarily until CMake exports actual custom commands
@@ -477,11 +626,14 @@ def parse_syscalls():
                 for inc in board.get("build.zephyr.syscall_include_dirs").split()
             ]
 
-            cmd.extend(['--include "%s"' % inc for inc in incs])
+            for inc in incs:
+                cmd.extend(("--include", inc))
 
         cmd.extend(("--json-file", syscalls_config, "--tag-struct-file", struct_tags))
 
-        env.Execute(env.VerboseAction(" ".join(cmd), "Parsing system calls..."))
+        if env.Execute(env.VerboseAction([cmd], "Parsing system calls...")) != 0:
+            sys.stderr.write("Error: Couldn't parse system calls\n")
+            env.Exit(1)
 
     return syscalls_config
 
@@ -491,12 +643,14 @@ def generate_syscall_files(syscalls_json, project_settings):
         BUILD_DIR, "zephyr", "include", "generated", "syscall_list.h"
     )
 
-    if os.path.isfile(syscalls_header):
+    input_digest = get_file_digest(env.subst(syscalls_json))
+
+    if is_generated_file_up_to_date([syscalls_header], input_digest):
         return
 
     cmd = [
         "$PYTHONEXE",
-        '"%s"' % os.path.join(FRAMEWORK_DIR, "scripts", "gen_syscalls.py"),
+        os.path.join(FRAMEWORK_DIR, "scripts", "gen_syscalls.py"),
         "--json-file",
         syscalls_json,
         "--base-output",
@@ -512,7 +666,58 @@ def generate_syscall_files(syscalls_json, project_settings):
     if project_settings.get("CONFIG_TIMEOUT_64BIT", False) == "1":
         cmd.extend(("--split-type", "k_timeout_t"))
 
-    env.Execute(env.VerboseAction(" ".join(cmd), "Generating syscall files"))
+    return cmd, "Generating syscall files", (syscalls_header, input_digest)
+
+
+def run_generator_cmds(generator_cmds):
+    # Generators depend only on the output of `parse_syscalls`. All of them are
+    # executed by a single generated driver script to pay the Python interpreter
+    # startup cost only once
+    driver_tpl = """# Warning! Do not edit, this file is generated on each build.
+import os
+import runpy
+import sys
+
+for label, argv in %s:
+    print(label)
+    sys.stdout.flush()
+    sys.argv = argv
+    sys.path.insert(0, os.path.dirname(argv[0]))
+    try:
+        runpy.run_path(argv[0], run_name="__main__")
+    except SystemExit as e:
+        if e.code:
+            sys.stderr.write("Error: Failed step: %%s\\n" %% label)
+            sys.exit(1)
+    finally:
+        sys.path.pop(0)
+"""
+
+    generator_cmds = [cmd for cmd in generator_cmds if cmd]
+    if not generator_cmds:
+        return
+
+    is_verbose = int(ARGUMENTS.get("PIOVERBOSE", 0))
+    steps = []
+    for cmd, description, _ in generator_cmds:
+        argv = [env.subst(arg) for arg in cmd]
+        # Python scripts are run in the driver, the interpreter is skipped
+        assert argv[0] == env.subst("$PYTHONEXE")
+        steps.append((" ".join(argv) if is_verbose else description, argv[1:]))
+
+    driver_script = os.path.join(BUILD_DIR, "_pio_prebuild.py")
+    with open(driver_script, "w") as fp:
+        fp.write(driver_tpl % repr(steps))
+
+    result = subprocess.run(
+        [env.subst("$PYTHONEXE"), driver_script], env=env["ENV"]
+    )
+    if result.returncode != 0:
+        env.Exit(1)
+
+    # Remember which input the outputs were generated from
+    for _, _, (output_file, input_digest) in generator_cmds:
+        store_file_digest(output_file, input_digest)
 
 
 def get_linkerscript_final_cmd(app_includes, base_ld_script):
@@ -538,21 +743,22 @@ def get_linkerscript_final_cmd(app_includes, base_ld_script):
         "$TARGET",
     ]
 
-    cmd.extend(['-I"%s"' % inc for inc in app_includes["plain_includes"]])
+    cmd.extend(["-I" + inc for inc in app_includes["plain_includes"]])
 
     return env.Command(
         os.path.join("$BUILD_DIR", "zephyr", "linker.cmd"),
         base_ld_script,
-        env.VerboseAction(" ".join(cmd), "Generating final linker script $TARGET"),
+        env.VerboseAction([cmd], "Generating final linker script $TARGET"),
     )
 
 
 def find_base_ldscript(app_includes):
     # A temporary solution since there is no easy way to find linker script
     for inc in app_includes["plain_includes"]:
-        for f in os.listdir(inc):
-            if f == "linker.ld" and os.path.isfile(os.path.join(inc, f)):
-                return os.path.join(inc, f)
+        with os.scandir(inc) as it:
+            for entry in it:
+                if entry.name == "linker.ld" and entry.is_file():
+                    return entry.path
 
     sys.stderr.write("Error: Couldn't find a base linker script!\n")
     env.Exit(1)
@@ -580,12 +786,12 @@ def get_linkerscript_cmd(app_includes, base_ld_script):
         "$TARGET",
     ]
 
-    cmd.extend(['-I"%s"' % inc for inc in app_includes["plain_includes"]])
+    cmd.extend(["-I" + inc for inc in app_includes["plain_includes"]])
 
     return env.Command(
         os.path.join("$BUILD_DIR", "zephyr", "linker_zephyr_prebuilt.cmd"),
         base_ld_script,
-        env.VerboseAction(" ".join(cmd), "Generating linker script $TARGET"),
+        env.VerboseAction([cmd], "Generating linker script $TARGET"),
     )
 
 
@@ -610,90 +816,182 @@ def extract_defines_from_compile_group(compile_group):
     )
 
     for f in compile_group.get("compileCommandFragments", []):
-        result.extend(env.ParseFlags(f.get("fragment", "")).get("CPPDEFINES", []))
+        result.extend(extract_defines_from_fragment(f.get("fragment", "")))
     return result
 
 
+# Flags that ParseFlags treats as taking the next argument when it's separate.
+# `-U` is not among them, ParseFlags doesn't consume an argument after it
+_SEPARATE_ARG_FLAGS = frozenset(
+    (
+        "-D",
+        "-I",
+        "-L",
+        "-l",
+        "-include",
+        "-imacros",
+        "-isysroot",
+        "-isystem",
+        "-iquote",
+        "-idirafter",
+        "-arch",
+        "--param",
+        "-framework",
+        "-dylib_file",
+        "-F",
+    )
+)
+
+
+def extract_defines_from_fragment(fragment):
+    # Only defines are required, so the full ParseFlags classification is avoided.
+    # Other flags are only checked for a separate argument that must be skipped,
+    # the result has the same format as CPPDEFINES returned by ParseFlags
+    result = []
+    next_arg_flag = None
+    for arg in split_args(fragment):
+        if next_arg_flag:
+            is_define = next_arg_flag == "-D"
+            next_arg_flag = None
+            if not is_define:
+                continue
+            define = arg
+        elif arg in _SEPARATE_ARG_FLAGS:
+            next_arg_flag = arg
+            continue
+        elif arg.startswith("-D"):
+            define = arg[2:]
+        else:
+            continue
+
+        result.append(define.split("=", 1) if "=" in define else define)
+
+    return result
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_flags_cached(flags):
+    return tuple((key, tuple(value)) for key, value in env.ParseFlags(flags).items())
+
+
+def parse_flags(flags):
+    # The same fragments are repeated across most compile groups
+    return {key: list(value) for key, value in _parse_flags_cached(flags)}
+
+
 def prepare_build_envs(config, default_env, config_extra=None):
     build_envs = []
-    target_compile_groups = [config.get("compileGroups", [])]
+    # Compile groups with identical flags, defines and includes share one environment
+    build_envs_pool = {}
+    compile_groups = config.get("compileGroups", [])
+    sources = config.get("sources", [])
     if config_extra:
-        target_compile_groups.append(config_extra.get("compileGroups", []))
+        compile_groups = compile_groups + config_extra.get("compileGroups", [])
+        sources = sources + config_extra.get("sources", [])
+    # Compile groups without any compiled sources are not turned into environments
+    used_compile_groups = {
+        s["compileGroupIndex"]
+        for s in sources
+        if "compileGroupIndex" in s and not s["path"].endswith(".rule")
+    }
     is_build_type_debug = "debug" in env.GetBuildType()
-    for tcg in target_compile_groups:
-        for cg in tcg:
-            includes = extract_includes_from_compile_group(cg, path_prefix=FRAMEWORK_DIR)
-            defines = extract_defines_from_compile_group(cg)
-            build_env = default_env.Clone()
-            compile_commands = cg.get("compileCommandFragments", [])
-
-            i = 0
-            length = len(compile_commands)
-            while i < length:
-                build_flags = compile_commands[i].get("fragment", "")
-                if build_flags.strip() in ("-imacros", "-include"):
-                    i += 1
-                    file_path = compile_commands[i].get("fragment", "")
-                    build_env.Append(CCFLAGS=[build_flags + file_path])
-                elif build_flags.strip() and not build_flags.startswith("-D"):
-                    build_env.AppendUnique(**build_env.ParseFlags(build_flags))
+    for cg_index, cg in enumerate(compile_groups):
+        if cg_index not in used_compile_groups:
+            # Keep indexes of compile groups aligned with sources
+            build_envs.append(None)
+            continue
+
+        includes = extract_includes_from_compile_group(
+            cg, path_prefix=FRAMEWORK_INCLUDE_PREFIX
+        )
+        defines = extract_defines_from_compile_group(cg)
+        compile_commands = cg.get("compileCommandFragments", [])
+        # Defines may contain lists, so the representation is used as the key
+        signature = repr(
+            (defines, includes, [f.get("fragment", "") for f in compile_commands])
+        )
+        if signature in build_envs_pool:
+            build_envs.append(build_envs_pool[signature])
+            continue
+
+        build_env = default_env.Clone()
+
+        i = 0
+        length = len(compile_commands)
+        while i < length:
+            build_flags = compile_commands[i].get("fragment", "")
+            if build_flags.strip() in ("-imacros", "-include"):
                 i += 1
-            build_env.AppendUnique(CPPDEFINES=defines, CPPPATH=includes["plain_includes"])
-            if includes["prefixed_includes"]:
-                build_env.Append(CCFLAGS=["-iprefix", fs.to_unix_path(FRAMEWORK_DIR)])
-                build_env.Append(
-                    CCFLAGS=[
-                        "-iwithprefixbefore/" + inc for inc in includes["prefixed_includes"]
-                    ]
-                )
-            if includes["sys_includes"]:
-                build_env.Append(
-                    CCFLAGS=["-isystem" + inc for inc in includes["sys_includes"]]
-                )
-            build_env.Append(ASFLAGS=build_env.get("CCFLAGS", [])[:])
-            build_env.ProcessUnFlags(default_env.get("BUILD_UNFLAGS"))
-            if is_build_type_debug:
-                build_env.ConfigureDebugFlags()
-            build_envs.append(build_env)
+                file_path = compile_commands[i].get("fragment", "")
+                build_env.Append(CCFLAGS=[build_flags + file_path])
+            elif build_flags.strip() and not build_flags.startswith("-D"):
+                build_env.AppendUnique(**parse_flags(build_flags))
+            i += 1
+        build_env.AppendUnique(CPPDEFINES=defines, CPPPATH=includes["plain_includes"])
+        if includes["prefixed_includes"]:
+            build_env.Append(CCFLAGS=["-iprefix", fs.to_unix_path(FRAMEWORK_DIR)])
+            build_env.Append(
+                CCFLAGS=[
+                    "-iwithprefixbefore/" + inc for inc in includes["prefixed_includes"]
+                ]
+            )
+        if includes["sys_includes"]:
+            build_env.Append(
+                CCFLAGS=["-isystem" + inc for inc in includes["sys_includes"]]
+            )
+        build_env.Append(ASFLAGS=build_env.get("CCFLAGS", [])[:])
+        build_env.ProcessUnFlags(default_env.get("BUILD_UNFLAGS"))
+        if is_build_type_debug:
+            build_env.ConfigureDebugFlags()
+        build_envs_pool[signature] = build_env
+        build_envs.append(build_env)
 
     return build_envs
 
 
+def is_abs_unix_path(path):
+    return path.startswith("/") or path[1:2] == ":"
+
+
 def compile_source_files(config, default_env, project_src_dir, prepend_dir=None, extra_config=None):
     build_envs = prepare_build_envs(config, default_env, extra_config)
     objects = []
-    targets = []
+    targets = set()
     rounds = [config]
     if extra_config:
         #cfg = extra_config
         rounds.append(extra_config)
+    # CMake File API reports all paths with forward slashes, so plain string
+    # operations are used in the loop below instead of `os.path` helpers
+    project_cmake_dir = fs.to_unix_path(os.path.join(PROJECT_DIR, "zephyr")) + "/"
     for cfg in rounds:
+        local_path = cfg["paths"]["source"]
+        if not is_abs_unix_path(local_path):
+            local_path = os.path.join(project_src_dir, cfg["paths"]["source"])
+        local_path = fs.to_unix_path(local_path).rstrip("/") + "/"
+        obj_path_temp = fs.to_unix_path(
+            os.path.join(
+                "$BUILD_DIR",
+                prepend_dir or cfg["name"].replace("framework-zephyr", ""),
+                cfg["paths"]["build"],
+            )
+        ).rstrip("/") + "/"
         for source in cfg.get("sources", []):
             if source["path"].endswith(".rule"):
                 continue
             compile_group_idx = source.get("compileGroupIndex")
             if compile_group_idx is not None:
                 src_path = source.get("path")
-                if not os.path.isabs(src_path):
+                if not is_abs_unix_path(src_path):
                     # For cases when sources are located near CMakeLists.txt
-                    src_path = os.path.join(PROJECT_DIR, "zephyr", src_path)
-                local_path = cfg["paths"]["source"]
-                if not os.path.isabs(local_path):
-                    local_path = os.path.join(project_src_dir, cfg["paths"]["source"])
-                obj_path_temp = os.path.join(
-                    "$BUILD_DIR",
-                    prepend_dir or cfg["name"].replace("framework-zephyr", ""),
-                    cfg["paths"]["build"],
-                )
+                    src_path = project_cmake_dir + src_path
                 if src_path.startswith(local_path):
-                    obj_path = os.path.join(
-                        obj_path_temp, os.path.relpath(src_path, local_path)
-                    )
+                    obj_path = obj_path_temp + src_path[len(local_path) :]
                 else:
-                    obj_path = os.path.join(obj_path_temp, os.path.basename(src_path))
-                current_target = os.path.join(obj_path + ".o")
+                    obj_path = obj_path_temp + src_path.rsplit("/", 1)[-1]
+                current_target = obj_path + ".o"
                 if current_target not in targets:
-                    targets.append(current_target)
+                    targets.add(current_target)
                     objects.append(
                         build_envs[compile_group_idx].StaticObject(
                             target=current_target,
@@ -709,15 +1007,7 @@ def get_app_includes(app_config):
 
 
 def extract_includes_from_compile_group(compile_group, path_prefix=None):
-    def _normalize_prefix(prefix):
-        prefix = fs.to_unix_path(prefix)
-        if not prefix.endswith("/"):
-            prefix = prefix + "/"
-        return prefix
-
-    if path_prefix:
-        path_prefix = _normalize_prefix(path_prefix)
-
+    # `path_prefix` is expected in Unix format with a trailing slash
     includes = []
     sys_includes = []
     prefixed_includes = []
@@ -726,9 +1016,7 @@ def extract_includes_from_compile_group(compile_group, path_prefix=None):
         if inc.get("isSystem", False):
             sys_includes.append(inc_path)
         elif path_prefix and inc_path.startswith(path_prefix):
-            prefixed_includes.append(
-                fs.to_unix_path(os.path.relpath(inc_path, path_prefix))
-            )
+            prefixed_includes.append(inc_path[len(path_prefix) :])
         else:
             includes.append(inc_path)
 
@@ -751,17 +1039,17 @@ def extract_link_args(target_config, target_config_extra=None):
     }
 
     is_whole_archive = False
-    cmd_fragments = target_config.get("link", {}).get("commandFragments", [])
+    # Reply data is cached and shared, so the list is copied before extending
+    cmd_fragments = list(target_config.get("link", {}).get("commandFragments", []))
     if target_config_extra:
         fragments_pre1 = target_config_extra.get("link", {}).get("commandFragments", [])
         cmd_fragments.extend([x for x in fragments_pre1 if x not in cmd_fragments])
-        print(json.dumps(cmd_fragments))
     for f in cmd_fragments:
         fragment = f.get("fragment", "").strip().replace("\\", "/")
         fragment_role = f.get("role", "").strip()
         if not fragment or not fragment_role:
             continue
-        args = click.parser.split_arg_string(fragment)
+        args = split_args(fragment)
         if "-Wl,--whole-archive" in fragment:
             is_whole_archive = True
         if "-Wl,--no-whole-archive" in fragment:
@@ -799,7 +1087,7 @@ def extract_link_args(target_config, target_config_extra=None):
 def generate_isr_list_binary(preliminary_elf, board):
     cmd = [
         "$OBJCOPY",
-        "--input-target=" + get_target_elf_arch(board),
+        "--input-target=" + get_target_elf_arch(),
         "--output-target=binary",
         "--only-section=.intList",
         "$SOURCE",
@@ -809,14 +1097,14 @@ def generate_isr_list_binary(preliminary_elf, board):
     return env.Command(
         os.path.join("$BUILD_DIR", "zephyr", "isrList.bin"),
         preliminary_elf,
-        env.VerboseAction(" ".join(cmd), "Generating ISR list $TARGET"),
+        env.VerboseAction([cmd], "Generating ISR list $TARGET"),
     )
 
 
 def generate_isr_table_file_cmd(preliminary_elf, board_config, project_settings):
     cmd = [
         "$PYTHONEXE",
-        '"%s"' % os.path.join(FRAMEWORK_DIR, "arch", "common", "gen_isr_tables.py"),
+        os.path.join(FRAMEWORK_DIR, "arch", "common", "gen_isr_tables.py"),
         "--output-source",
         "$TARGET",
         "--kernel",
@@ -833,7 +1121,7 @@ def generate_isr_table_file_cmd(preliminary_elf, board_config, project_settings)
     cmd = env.Command(
         os.path.join("$BUILD_DIR", "zephyr", "isr_tables.c"),
         [preliminary_elf, os.path.join("$BUILD_DIR", "zephyr", "isrList.bin")],
-        env.VerboseAction(" ".join(cmd), "Generating ISR table $TARGET"),
+        env.VerboseAction([cmd], "Generating ISR table $TARGET"),
     )
 
     env.Requires(cmd, generate_isr_list_binary(preliminary_elf, board_config))
@@ -844,7 +1132,7 @@ def generate_isr_table_file_cmd(preliminary_elf, board_config, project_settings)
 def generate_offset_header_file_cmd():
     cmd = [
         "$PYTHONEXE",
-        '"%s"' % os.path.join(FRAMEWORK_DIR, "scripts", "gen_offset_header.py"),
+        os.path.join(FRAMEWORK_DIR, "scripts", "gen_offset_header.py"),
         "-i",
         "$SOURCE",
         "-o",
@@ -858,39 +1146,40 @@ def generate_offset_header_file_cmd():
             "offsets",
             "zephyr",
             "arch",
-            get_board_architecture(board),
+            get_board_architecture(),
             "core",
             "offsets",
             "offsets.c.o",
         ),
-        env.VerboseAction(" ".join(cmd), "Generating header file with offsets $TARGET"),
+        env.VerboseAction([cmd], "Generating header file with offsets $TARGET"),
     )
 
 def generate_version_header_file_cmd():
     cmd = [
-        '"%s"' % os.path.join(platform.get_package_dir("tool-cmake"), "bin", "cmake"),
-        '-DZEPHYR_BASE="%s"' % FRAMEWORK_DIR,
-        '-DOUT_FILE="%s"' % os.path.join("$BUILD_DIR", "zephyr", "include", "generated", "version.h"),
-        "-DBUILD_VERSION=$BUILD_VERSION",
+        CMAKE_BIN,
+        "-DZEPHYR_BASE=%s" % FRAMEWORK_DIR,
+        # Variables inside an argument of a list action are split on whitespace
+        "-DOUT_FILE=%s" % os.path.join(BUILD_DIR, "zephyr", "include", "generated", "version.h"),
+        "-DBUILD_VERSION=%s" % env.subst("$BUILD_VERSION"),
         "-P",
-        '"%s"' % os.path.join(FRAMEWORK_DIR, "cmake", "gen_version_h.cmake"),
+        os.path.join(FRAMEWORK_DIR, "cmake", "gen_version_h.cmake"),
     ]
 
-    env.Execute(env.VerboseAction(" ".join(cmd), "Generating header file with version.h for $TARGET"))
+    env.Execute(env.VerboseAction([cmd], "Generating header file with version.h for $TARGET"))
 
 
 def filter_args(args, allowed, ignore=None):
     if not allowed:
         return []
 
-    ignore = ignore or []
+    # `str.startswith` accepts a tuple of prefixes and checks them all at once
+    allowed = tuple(allowed)
+    ignore = tuple(ignore or ())
     result = []
     i = 0
     length = len(args)
     while i < length:
-        if any(args[i].startswith(f) for f in allowed) and not any(
-            args[i].startswith(f) for f in ignore
-        ):
+        if args[i].startswith(allowed) and not args[i].startswith(ignore):
             result.append(args[i])
             if i + 1 < length and not args[i + 1].startswith("-"):
                 i += 1
@@ -899,24 +1188,35 @@ def filter_args(args, allowed, ignore=None):
     return result
 
 
-def load_project_settings():
+def load_project_settings(config_file=None):
+    return _load_kconfig_file(
+        os.path.abspath(config_file or os.path.join(BUILD_DIR, "zephyr", ".config"))
+    )
+
+
+@functools.lru_cache(maxsize=4)
+def _load_kconfig_file(config_file):
+    # Cached settings are shared, so a read-only view is returned
     result = {}
-    config_re = re.compile(r"^([^#=]+)=(.+)$")
-    config_file = os.path.join(BUILD_DIR, "zephyr", ".config")
     if not os.path.isfile(config_file):
         print("Warning! Missing project configuration file `%s`" % config_file)
-        return {}
+        return types.MappingProxyType(result)
 
     with open(config_file) as f:
-        for line in f:
-            re_match = config_re.match(line)
-            if re_match:
-                config_value = re_match.group(2)
-                if config_value.startswith('"') and config_value.endswith('"'):
-                    config_value = config_value[1:-1]
-                result[re_match.group(1)] = config_value
+        data = f.read()
 
-    return result
+    # Lines are in the simple `KEY=VALUE` format, comments start with `#`
+    for line in data.splitlines():
+        if not line or line[0] == "#":
+            continue
+        config_name, sep, config_value = line.partition("=")
+        if not sep or not config_name or not config_value or "#" in config_name:
+            continue
+        if len(config_value) > 1 and config_value[0] == config_value[-1] == '"':
+            config_value = config_value[1:-1]
+        result[config_name] = config_value
+
+    return types.MappingProxyType(result)
 
 
 def RunMenuconfig(target, source, env):
@@ -925,7 +1225,7 @@ def RunMenuconfig(target, source, env):
 
     rc = subprocess.call(
         [
-            os.path.join(platform.get_package_dir("tool-cmake"), "bin", "cmake"),
+            CMAKE_BIN,
             "--build",
             BUILD_DIR,
             "--target",
@@ -940,23 +1240,23 @@ def RunMenuconfig(target, source, env):
 
 
 def get_project_lib_deps(modules_map, main_config):
-    def _collect_lib_deps(config, libs=None):
-        libs = libs or {}
-        deps = config.get("dependencies", [])
-        if not deps:
-            return []
-
-        for d in config["dependencies"]:
+    # Iterative traversal, Zephyr dependency graphs can be quite deep
+    libs = {}
+    configs = [main_config]
+    while configs:
+        config = configs.pop()
+        dependencies = config.get("dependencies")
+        if not dependencies:
+            continue
+        for d in dependencies:
             dependency_id = d["id"]
-            if not modules_map.get(dependency_id, {}):
+            module = modules_map.get(dependency_id)
+            if not module or dependency_id in libs:
                 continue
-            if dependency_id not in libs:
-                libs[dependency_id] = modules_map[dependency_id]
-                _collect_lib_deps(libs[dependency_id]["config"], libs)
+            libs[dependency_id] = module
+            configs.append(module["config"])
 
-        return libs
-
-    return _collect_lib_deps(main_config)
+    return libs
 
 
 def load_west_manifest(manifest_path):
@@ -964,9 +1264,9 @@ def load_west_manifest(manifest_path):
         sys.stderr.write("Error: Couldn't find `%s`\n" % manifest_path)
         env.Exit(1)
 
-    with open(manifest_path) as fp:
+    with open(manifest_path, "rb") as fp:
         try:
-            return yaml.safe_load(fp).get("manifest", {})
+            return yaml.load(fp, Loader=YamlSafeLoader).get("manifest", {})
         except yaml.YAMLError as e:
             sys.stderr.write("Warning! Failed to parse `%s`.\n" % manifest_path)
             sys.stderr.write(str(e) + "\n")
@@ -994,11 +1294,10 @@ def prepare_package_url(remotes, default_remote_name, package_config):
     return remote_url + ".git"
 
 
-def get_package_requirement(package_config):
-    package_revision = package_config["revision"]
-    # At least 10 symbols are required in commit hash
-    hash_re = re.compile(r"[0-9a-f]{10,40}")
-    if hash_re.match(package_revision):
+@functools.lru_cache(maxsize=256)
+def get_revision_requirement(package_revision):
+    # Many packages share the same release tag
+    if COMMIT_HASH_RE.match(package_revision):
         return "0.0.0-alpha+sha.%s" % package_revision[:10]
     elif package_revision.startswith("v") and "." in package_revision:
         # Remove 'v' and try to get a valid semver version
@@ -1013,6 +1312,10 @@ def get_package_requirement(package_config):
     return None
 
 
+def get_package_requirement(package_config):
+    return get_revision_requirement(package_config["revision"])
+
+
 def install_from_remote(package_config, dst_dir, remotes, default_remote):
     remote_url = prepare_package_url(remotes, default_remote, package_config)
     revision = package_config["revision"] if "revision" in package_config else "master"
@@ -1023,7 +1326,7 @@ def install_from_remote(package_config, dst_dir, remotes, default_remote):
         )
         return
 
-    os.makedirs(dst_dir)
+    os.makedirs(dst_dir, exist_ok=True)
     vcs = None
     if package_config.get("submodules", False):
         vcs = GitClient(fs.to_unix_path(dst_dir), remote_url, revision, True)
@@ -1045,8 +1348,8 @@ def install_from_registry(project_config, package_manager, package_path):
     try:
         pkg = package_manager.install(spec, silent=True)
         if os.path.isdir(pkg.path):
-            if not os.path.isdir(os.path.dirname(package_path)):
-                os.makedirs(os.path.dirname(package_path))
+            # Packages are installed concurrently and may share parent folders
+            os.makedirs(os.path.dirname(package_path), exist_ok=True)
             # Move the folder to proper location in the Zephyr package
             shutil.move(pkg.path, package_path)
             assert os.path.isdir(package_path)
@@ -1076,27 +1379,63 @@ def process_bundled_packages(west_manifest):
     default_remote = west_manifest.get("defaults", {}).get("remote", "")
     remotes = {remote["name"]: remote for remote in west_manifest["remotes"]}
 
-    with tempfile.TemporaryDirectory(prefix="_pio") as tmpdir:
-        # Built-in PlatformIO Package manager to download remote packages
-        pm = ToolPackageManager(tmpdir)
-        # Install missing packages
-        for project_config in west_manifest.get("projects", []):
-            if not is_project_required(project_config):
+    # Top-level entries are listed once, most packages can be checked without stat
+    installed_entries = scan_dir_entries(packages_root)
+
+    missing_packages = []
+    for project_config in west_manifest.get("projects", []):
+        if not is_project_required(project_config):
+            continue
+
+        project_name = project_config["name"]
+        package_rel_path = project_config.get("path", project_name)
+        package_path = os.path.join(packages_root, package_rel_path)
+        top_entry = installed_entries.get(package_rel_path.split("/")[0])
+        if top_entry is None or not top_entry.is_dir():
+            installed = False
+        elif "/" in package_rel_path:
+            installed = os.path.isdir(package_path)
+        else:
+            installed = True
+        if not installed:
+            if project_name == "trusted-firmware-m":
+                # Support for this module is not implemented
                 continue
+            missing_packages.append((project_config, package_path))
 
-            project_name = project_config["name"]
-            package_path = os.path.join(
-                packages_root, project_config.get("path", project_name)
-            )
-            if not os.path.isdir(package_path):
-                if project_name == "trusted-firmware-m":
-                    # Support for this module is not implemented
-                    continue
-                print("Installing `%s` package..." % project_name)
-                if not install_from_registry(project_config, pm, package_path):
-                    install_from_remote(
-                        project_config, package_path, remotes, default_remote
+    if not missing_packages:
+        return
+
+    with tempfile.TemporaryDirectory(prefix="_pio") as tmpdir:
+
+        def _install_package(item):
+            project_config, package_path = item
+            print("Installing `%s` package..." % project_config["name"])
+            # Built-in PlatformIO Package manager to download remote packages,
+            # a separate instance per package as downloads run in parallel
+            pm = ToolPackageManager(tempfile.mkdtemp(dir=tmpdir))
+            if not install_from_registry(project_config, pm, package_path):
+                install_from_remote(
+                    project_config, package_path, remotes, default_remote
+                )
+
+        # Downloads and Git clones are I/O bound, run them concurrently
+        with ThreadPoolExecutor(max_workers=min(8, len(missing_packages))) as executor:
+            futures = {
+                executor.submit(_install_package, item): item[0]["name"]
+                for item in missing_packages
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    # Don't start the remaining downloads after the first failure
+                    for pending in futures:
+                        pending.cancel()
+                    sys.stderr.write(
+                        "Error: Failed to install `%s` package\n" % futures[future]
                     )
+                    raise
 
 
 def generate_default_component():
@@ -1118,19 +1457,21 @@ build:
     if not os.path.isdir(dummy_component_path):
         os.makedirs(dummy_component_path)
 
+    # List the component folder once instead of checking each file separately
+    existing = scan_dir_entries(dummy_component_path)
+
     for ext in (".cpp", ".c", ".S"):
-        dummy_src_file = os.path.join(dummy_component_path, "__dummy" + ext)
-        if not os.path.isfile(dummy_src_file):
-            open(dummy_src_file, "a").close()
+        if "__dummy" + ext not in existing:
+            open(os.path.join(dummy_component_path, "__dummy" + ext), "a").close()
 
-    component_cmake = os.path.join(dummy_component_path, "CMakeLists.txt")
-    if not os.path.isfile(component_cmake):
+    if "CMakeLists.txt" not in existing:
+        component_cmake = os.path.join(dummy_component_path, "CMakeLists.txt")
         with open(component_cmake, "w") as fp:
             fp.write(prj_cmake_tpl)
 
     zephyr_module_config = os.path.join(dummy_component_path, "zephyr", "module.yml")
-    if not os.path.isfile(zephyr_module_config):
-        if not os.path.isdir(zephyr_module_config):
+    if "zephyr" not in existing or not os.path.isfile(zephyr_module_config):
+        if "zephyr" not in existing:
             os.makedirs(os.path.dirname(zephyr_module_config))
         with open(zephyr_module_config, "w") as fp:
             fp.write(module_cfg_tpl)
@@ -1149,9 +1490,7 @@ def get_default_build_flags(app_config, default_config):
                 fragment = ccfragment.get("fragment", "")
                 if not fragment.strip() or fragment.startswith("-D"):
                     continue
-                flags[cg["language"]].extend(
-                    click.parser.split_arg_string(fragment.strip())
-                )
+                flags[cg["language"]].extend(split_args(fragment.strip()))
 
         return flags
 
@@ -1168,9 +1507,7 @@ def get_default_build_flags(app_config, default_config):
 def is_project_required(project_config):
     # Some packages are not
     project_name = project_config["name"]
-    if project_name.startswith("hal_") and project_name[
-        4:
-    ] not in PLATFORMS_WITH_EXTERNAL_HAL.get(env.subst("$PIOPLATFORM"), []):
+    if project_name.startswith("hal_") and project_name[4:] not in EXTERNAL_HALS:
         return False
 
     if project_config["path"].startswith("tool") or project_name.startswith("nrf_hw_"):
@@ -1191,37 +1528,38 @@ def process_project_lib_deps(
 ):
     # Get rid of the `app` library as the project source files are handled by PlatformIO
     # and linker as object files in the linker command
+    app_lib_names = ("app.a", "libapp.a")
     whole_libs = [
-        lib for lib in project_libs["whole_libs"] if "app.a" not in lib
+        lib
+        for lib in project_libs["whole_libs"]
+        if os.path.basename(lib) not in app_lib_names
+    ]
+
+    # Library paths are relative to the build folder, SCons normalizes separators
+    whole_lib_paths = ["$BUILD_DIR/" + library for library in whole_libs]
+    generic_lib_paths = [
+        "$BUILD_DIR/" + library for library in project_libs["generic_libs"]
     ]
 
     # Some of the project libraries should be linked entirely, so they are manually
     # wrapped inside the `--whole-archive` and `--no-whole-archive` flags.
-    env.Append(
-        LIBPATH=lib_paths,
-        _LIBFLAGS=" -Wl,--whole-archive "
-        + " ".join(
-            [os.path.join("$BUILD_DIR", library) for library in whole_libs]
-            + [offsets_lib[0].get_abspath()]
-        )
-        + " -Wl,--no-whole-archive "
-        + " ".join(
-            [
-                os.path.join("$BUILD_DIR", library)
-                for library in project_libs["generic_libs"]
-            ]
-            + project_libs["standard_libs"]
-        ),
-    )
+    lib_flags = ["-Wl,--whole-archive"]
+    lib_flags.extend(whole_lib_paths)
+    lib_flags.append(offsets_lib[0].get_abspath())
+    lib_flags.append("-Wl,--no-whole-archive")
+    lib_flags.extend(generic_lib_paths)
+    lib_flags.extend(project_libs["standard_libs"])
+    # Leading space separates the flags from the previous content of _LIBFLAGS
+    env.Append(LIBPATH=lib_paths, _LIBFLAGS=" " + " ".join(lib_flags))
 
     # Note: These libraries are not added to the `LIBS` section. Hence they must be
     # specified as explicit dependencies.
     env.Depends(
         preliminary_elf_path,
         [
-            os.path.join("$BUILD_DIR", library)
-            for library in project_libs["generic_libs"] + whole_libs
-            if "app" not in library
+            path
+            for path in generic_lib_paths + whole_lib_paths
+            if os.path.basename(path) not in app_lib_names
         ],
     )
 
@@ -1230,11 +1568,15 @@ def process_project_lib_deps(
 # Current build script limitations
 #
 
-env.EnsurePythonVersion(3, 4)
+# The checks are performed only once per construction environment
+if not env.get("__ZEPHYR_ENV_CHECKED", False):
+    env.EnsurePythonVersion(3, 4)
 
-if " " in FRAMEWORK_DIR:
-    sys.stderr.write("Error: Detected a whitespace character in framework path\n")
-    env.Exit(1)
+    if " " in FRAMEWORK_DIR:
+        sys.stderr.write("Error: Detected a whitespace character in framework path\n")
+        env.Exit(1)
+
+    env["__ZEPHYR_ENV_CHECKED"] = True
 
 #
 # Process Zephyr internal packages
@@ -1278,15 +1620,20 @@ project_settings = load_project_settings()
 offset_header_file = generate_offset_header_file_cmd()
 generate_version_header_file_cmd()
 syscalls_config = parse_syscalls()
-generate_syscall_files(syscalls_config, project_settings)
-generate_kobject_files()
-validate_driver()
+run_generator_cmds(
+    (
+        generate_syscall_files(syscalls_config, project_settings),
+        generate_kobject_files(),
+        validate_driver(),
+    )
+)
 
 #
 # LD scripts processing
 #
 
 app_includes = get_app_includes(app_config)
+sys_include_flags = [("-isystem", inc) for inc in app_includes.get("sys_includes", [])]
 base_ld_script = find_base_ldscript(app_includes)
 final_ld_script = get_linkerscript_final_cmd(app_includes, base_ld_script)
 preliminary_ld_script = get_linkerscript_cmd(app_includes, base_ld_script)
@@ -1309,14 +1656,22 @@ if (
     )
 
 if "build.embed_files" in board:
-    for f in board.get("build.embed_files", "").split():
-        file = os.path.join(PROJECT_DIR, f)
-        if not os.path.isfile(env.subst(f)):
-            print('Warning! Could not find file "%s"' % os.path.basename(f))
+    embed_files = [
+        os.path.join(PROJECT_DIR, env.subst(f))
+        for f in board.get("build.embed_files", "").split()
+    ]
+    # Files are usually grouped in a few folders, each folder is listed only once
+    embed_dirs_entries = {
+        embed_dir: scan_dir_entries(embed_dir)
+        for embed_dir in set(os.path.dirname(file) for file in embed_files)
+    }
+    for file in embed_files:
+        entry = embed_dirs_entries[os.path.dirname(file)].get(os.path.basename(file))
+        if entry is None or not entry.is_file():
+            print('Warning! Could not find file "%s"' % os.path.basename(file))
             continue
 
         env.Depends(offset_header_file, generate_includible_file(file))
-        env.Depends(version_header_file, generate_includible_file(file))
 
 #
 # Libraries processing
@@ -1324,34 +1679,40 @@ if "build.embed_files" in board:
 
 #env.Append(CPPDEFINES=[("BUILD_VERSION", "zephyr-v" + FRAMEWORK_VERSION.split(".")[1])])
 
-framework_modules_map = {}
-for target, target_config in target_configs.items():
-    lib_name = target_config["name"]
-    if (
-        target_config["type"]
-        not in (
-            "STATIC_LIBRARY",
-            "OBJECT_LIBRARY"
-        )
-        or lib_name in ("app", "offsets")
-    ):
-        #print('ignoring: {}'.format(lib_name))
-        #if lib_name == 'version_h':
-        #    print(target_config)
-        continue
+# Targets that require generated headers, e.g. offsets.h, to be built first
+generated_headers_dependents = {
+    target_config["id"]
+    for target_config in target_configs.values()
+    if any(
+        d.get("id", "").startswith("zephyr_generated_headers")
+        for d in target_config.get("dependencies", [])
+    )
+}
 
+framework_libs = [
+    target_config
+    for target_config in target_configs.values()
+    if target_config["type"] in ("STATIC_LIBRARY", "OBJECT_LIBRARY")
+    and target_config["name"] not in ("app", "offsets")
+]
+
+# SCons node construction is not thread-safe, so libraries are declared serially
+framework_modules_map = {}
+for target_config in framework_libs:
     lib = build_library(env, target_config, PROJECT_SRC_DIR)
     framework_modules_map[target_config["id"]] = {
         "lib_path": lib[0],
         "config": target_config,
     }
 
-    if any(
-        d.get("id", "").startswith("zephyr_generated_headers")
-        for d in target_config.get("dependencies", [])
-    ):
-        env.Depends(lib[0].sources, offset_header_file)
-        #env.Depends(lib[0].sources, version_header_file)
+header_dependent_sources = []
+for target_config in framework_libs:
+    if target_config["id"] in generated_headers_dependents:
+        header_dependent_sources.extend(
+            framework_modules_map[target_config["id"]]["lib_path"].sources
+        )
+if header_dependent_sources:
+    env.Depends(header_dependent_sources, offset_header_file)
 
 # Offsets library compiled separately as it's used later for custom dependencies
 offsets_lib = build_library(env, target_configs["offsets"], PROJECT_SRC_DIR)
@@ -1388,13 +1749,12 @@ for dep in (isr_table_file, final_ld_script):
 #linker_arguments = extract_link_args(prebuilt_config, prebuilt1_config)
 linker_arguments = extract_link_args(prebuilt_config)
 
-# remove the main linker script flags '-T linker.cmd'
-try:
-    ld_index = linker_arguments["link_flags"].index("linker.cmd")
-    linker_arguments["link_flags"].pop(ld_index)
-    linker_arguments["link_flags"].pop(ld_index - 1)
-except:
-    pass
+# remove the main linker script flags '-T linker.cmd', usually placed at the end
+link_flags = linker_arguments["link_flags"]
+for ld_index in range(len(link_flags) - 1, 0, -1):
+    if link_flags[ld_index] == "linker.cmd" and link_flags[ld_index - 1] == "-T":
+        del link_flags[ld_index - 1 : ld_index + 1]
+        break
 
 # Flags shouldn't be merged automatically as they have precise position in linker cmd
 ignore_flags = ("CMakeFiles", "-Wl,--whole-archive", "-Wl,--no-whole-archive", "-Wl,-T")
@@ -1421,7 +1781,7 @@ process_project_lib_deps(
 env.Replace(ARFLAGS=["qc"])
 env.Append(
     CPPPATH=app_includes["plain_includes"],
-    CCFLAGS=[("-isystem", inc) for inc in app_includes.get("sys_includes", [])],
+    CCFLAGS=sys_include_flags,
     CPPDEFINES=get_app_defines(app_config),
     LINKFLAGS=linker_arguments["link_flags"],
 )
@@ -1479,7 +1839,7 @@ env.Append(
     )
 )
 
-if get_board_architecture(board) == "arm":
+if get_board_architecture() == "arm":
     env.Replace(
         SIZEPROGREGEXP=r"^(?:text|_TEXT_SECTION_NAME_2|sw_isr_table|devconfig|rodata|\.ARM.exidx)\s+(\d+).*",
         SIZEDATAREGEXP=r"^(?:datas|bss|noinit|initlevel|_k_mutex_area|_k_stack_area)\s+(\d+).*",